@@ -87,12 +87,12 @@ cases will be shown in yellow. You need an ANSI terminal to use this.
 """
 
 import doctest
+import functools
 import inspect
 import os
 import re
 import types
 import unittest
-from StringIO import StringIO
 
 try:
     from unittest.runner import _WritelnDecorator  # Python 2.7
@@ -107,10 +107,68 @@ from nose.plugins import Plugin
 ## Functions for constructing specifications based on nose testing objects.
 ################################################################################
 
-def dispatch_on_type(dispatch_table, instance):
-    for type, func in dispatch_table:
-        if type is True or isinstance(instance, type):
+_camel_re = re.compile(r'([A-Z])')
+
+
+# Descriptions of contexts (modules, classes, doctests) computed during the
+# current run, keyed by id() of the context. The context itself is stored
+# alongside its description so that the id cannot be reused by another object.
+_description_cache = {}
+
+
+def memoize_description(func):
+    """Cache descriptions returned by func for the duration of a test run,
+    by identity of the described object.
+    """
+    @functools.wraps(func)
+    def memoized(object):
+        cached = _description_cache.get(id(object))
+        if cached is not None:
+            return cached[1]
+        description = func(object)
+        _description_cache[id(object)] = (object, description)
+        return description
+    return memoized
+
+
+def clear_description_cache():
+    _description_cache.clear()
+
+
+def memoize(func):
+    """Cache results of a function taking a single hashable argument.
+    """
+    cache = {}
+    @functools.wraps(func)
+    def memoized(argument):
+        try:
+            return cache[argument]
+        except KeyError:
+            result = cache[argument] = func(argument)
+            return result
+    return memoized
+
+
+def type_dispatcher(dispatch_table):
+    """Build a function dispatching on type of its argument.
+
+    Dispatch table is a list of (type, func) pairs, where True as a type
+    matches anything. Function chosen for each exact type is remembered,
+    so that the table is scanned only once per type.
+    """
+    resolved = {}
+    def lookup(instance):
+        for type, func in dispatch_table:
+            if type is True or isinstance(instance, type):
+                return func
+    def dispatch(instance):
+        try:
+            func = resolved[type(instance)]
+        except KeyError:
+            func = resolved[type(instance)] = lookup(instance)
+        if func is not None:
             return func(instance)
+    return dispatch
 
 
 def remove_leading(needle, haystack):
@@ -121,7 +179,7 @@ def remove_leading(needle, haystack):
     >>> remove_leading('Test', 'ArbitraryName')
     'ArbitraryName'
     """
-    if haystack[:len(needle)] == needle:
+    if haystack.startswith(needle):
         return haystack[len(needle):]
     return haystack
 
@@ -133,8 +191,10 @@ def remove_trailing(needle, haystack):
     'ThisAndThat'
     >>> remove_trailing('Test', 'ArbitraryName')
     'ArbitraryName'
+    >>> remove_trailing('', 'ArbitraryName')
+    'ArbitraryName'
     """
-    if haystack[-len(needle):] == needle:
+    if needle and haystack.endswith(needle):
         return haystack[:-len(needle)]
     return haystack
 
@@ -154,7 +214,14 @@ def camel2word(string):
     def wordize(match):
         return ' ' + match.group(1).lower()
 
-    return string[0] + re.sub(r'([A-Z])', wordize, string[1:])
+    return string[0] + _camel_re.sub(wordize, string[1:])
+
+
+contractions = {"dont": "don't",
+                "doesnt": "doesn't",
+                "wont": "won't",
+                "wasnt": "wasn't"}
+_contractions_re = re.compile(r"\b(?:%s)\b" % "|".join(contractions))
 
 
 def complete_english(string):
@@ -163,13 +230,10 @@ def complete_english(string):
     "don't do this"
     >>> complete_english('doesnt is matched as well')
     "doesn't is matched as well"
+    >>> complete_english('wont change the wontons')
+    "won't change the wontons"
     """
-    for x, y in [("dont", "don't"),
-                ("doesnt", "doesn't"),
-                ("wont", "won't"),
-                ("wasnt", "wasn't")]:
-        string = string.replace(x, y)
-    return string
+    return _contractions_re.sub(lambda match: contractions[match.group(0)], string)
 
 
 def underscore2word(string):
@@ -185,21 +249,43 @@ def argumentsof(test):
     return ""
 
 
+def getdoc(object):
+    """Get cleaned up docstring of an object, like inspect.getdoc, but without
+    any work for the common case of an object that has no docstring.
+    """
+    doc = getattr(object, '__doc__', None)
+    if doc and isinstance(doc, basestring):
+        return inspect.cleandoc(doc)
+    return None
+
+
+@memoize
 def underscored2spec(name):
-    return complete_english(underscore2word(remove_trailing('_test', remove_leading('test_', name))))
+    """Convert name of test function, method or module to a specification.
+
+    >>> underscored2spec('test_doesnt_work_with_sets')
+    "doesn't work with sets"
+    >>> underscored2spec('wont_break_on_wontons_test')
+    "won't break on wontons"
+    >>> underscored2spec('pkg.dont_break')
+    "pkg.don't break"
+    """
+    name = remove_trailing('_test', remove_leading('test_', name))
+    return complete_english(underscore2word(name))
 
 
+@memoize
 def camelcase2spec(name):
     return camel2word(remove_leading_and_trailing('Test', name))
 
 
 def camelcaseDescription(object):
-    description = inspect.getdoc(object) or camelcase2spec(object.__name__)
+    description = getdoc(object) or camelcase2spec(object.__name__)
     return description.strip()
 
 
 def underscoredDescription(object):
-    return inspect.getdoc(object) or underscored2spec(object.__name__).capitalize()
+    return getdoc(object) or underscored2spec(object.__name__).capitalize()
 
 
 def doctestContextDescription(doctest):
@@ -207,7 +293,7 @@ def doctestContextDescription(doctest):
 
 
 def noseMethodDescription(test):
-    return inspect.getdoc(test.method) or underscored2spec(test.method.__name__)
+    return getdoc(test.method) or underscored2spec(test.method.__name__)
 
 
 def unittestMethodDescription(test):
@@ -231,39 +317,61 @@ def noseFunctionDescription(test):
 # of specifications.
 def doctestExamplesDescription(test):
     for ex in test._dt_test.examples:
-        source = ex.source.replace("\n", " ")
-        want = None
-        if '#' in source:
-            source, want = source.rsplit('#', 1)
+        head, comment, tail = ex.source.rpartition('#')
+        if comment:
+            source, want = head, tail.replace("\n", " ")
         elif ex.exc_msg:
-            want = "throws \"%s\"" % ex.exc_msg.rstrip()
+            source, want = tail, "throws \"%s\"" % ex.exc_msg.rstrip()
         elif ex.want:
-            want = "returns %s" % ex.want.replace("\n", " ")
+            source, want = tail, "returns %s" % ex.want.replace("\n", " ")
+        else:
+            continue
 
         if want:
-            yield "%s %s" % (source.strip(), want.strip())
+            yield "%s %s" % (source.replace("\n", " ").strip(), want.strip())
+
+
+def single_specification(description):
+    """Adapt function returning one specification to return a tuple of them,
+    so that all test descriptions can be iterated over.
+    """
+    def specifications(test):
+        spec = description(test)
+        if spec:
+            return (spec,)
+        return ()
+    return specifications
+
+
+supported_test_types = [
+    (nose.case.MethodTestCase, single_specification(noseMethodDescription)),
+    (nose.case.FunctionTestCase, single_specification(noseFunctionDescription)),
+    (doctest.DocTestCase, doctestExamplesDescription),
+    (unittest.TestCase, single_specification(unittestMethodDescription)),
+]
+_dispatch_test = type_dispatcher(supported_test_types)
 
 
 def testDescription(test):
-    supported_test_types = [
-        (nose.case.MethodTestCase, noseMethodDescription),
-        (nose.case.FunctionTestCase, noseFunctionDescription),
-        (doctest.DocTestCase, doctestExamplesDescription),
-        (unittest.TestCase, unittestMethodDescription),
-    ]
-    return dispatch_on_type(supported_test_types, test.test)
+    """Return an iterable of specifications for given test.
+    """
+    return _dispatch_test(test.test) or ()
+
+
+supported_context_types = [
+    (types.ModuleType, underscoredDescription),
+    (types.FunctionType, underscoredDescription),
+    (doctest.DocTestCase, doctestContextDescription),
+    # Handle both old and new style classes.
+    (types.ClassType, camelcaseDescription),
+    (type, camelcaseDescription),
+]
+_dispatch_context = type_dispatcher(supported_context_types)
 
 
+@memoize_description
 def contextDescription(context):
-    supported_context_types = [
-        (types.ModuleType, underscoredDescription),
-        (types.FunctionType, underscoredDescription),
-        (doctest.DocTestCase, doctestContextDescription),
-        # Handle both old and new style classes.
-        (types.ClassType, camelcaseDescription),
-        (type, camelcaseDescription),
-    ]
-    return dispatch_on_type(supported_context_types, context)
+    return _dispatch_context(context)
 
 
 def testContext(test):
@@ -282,9 +390,32 @@ def testContext(test):
 ## Output stream that can be easily enabled and disabled.
 ################################################################################
 
+# Shared by all output streams, never closed.
+devnull = open(os.devnull, 'w')
+
+
+class CaptureStream(object):
+    """Minimal file-like object collecting everything written to it.
+    """
+    def __init__(self):
+        self.chunks = []
+        self.write = self.chunks.append
+
+    def writelines(self, lines):
+        self.chunks.extend(lines)
+
+    def flush(self):
+        pass
+
+    def getvalue(self):
+        value = ''.join(self.chunks)
+        self.chunks[:] = [value]
+        return value
+
+
 class OutputStream(_WritelnDecorator):
     def __init__(self, on_stream, off_stream):
-        self.capture_stream = StringIO()
+        self.capture_stream = CaptureStream()
         self.on_stream = on_stream
         self.off_stream = off_stream
         self.stream = on_stream
@@ -296,12 +427,10 @@ class OutputStream(_WritelnDecorator):
         self.stream = self.off_stream
 
     def capture(self):
-        self.capture_stream.truncate()
         self.stream = self.capture_stream
 
     def get_captured(self):
-        self.capture_stream.seek(0)
-        return self.capture_stream.read()
+        return self.capture_stream.getvalue()
 
 
 class SpecOutputStream(OutputStream):
@@ -317,11 +446,7 @@ class SpecOutputStream(OutputStream):
         self.print_line("\n%s" % contextDescription(context))
 
     def print_spec(self, colorized, test, status=None):
-        spec = testDescription(test)
-        if isinstance(spec, types.GeneratorType):
-            for s in spec:
-                self._print_spec(colorized, s, status)
-        elif spec:
+        for spec in testDescription(test):
             self._print_spec(colorized, spec, status)
 
     def _print_spec(self, colorized, spec, status=None):
@@ -342,14 +467,38 @@ def in_color(color, text):
     """Colorize text, adding color to each line so that the color shows up
     correctly with the less -R as well as more and normal shell.
     """
-    return "".join("%s%s%s" % (colors[color], line, color_end)
-                                       for line in text.splitlines(True))
+    return colorizer(color)(text)
+
+
+def colorizer(color):
+    """Return a function that colorizes text the way in_color does.
+    """
+    prefix = colors[color]
+    def colorize(text):
+        # Specifications are usually one-liners. Unicode text has more
+        # line breaks than str, so it always gets split.
+        if type(text) is str and text and '\n' not in text and '\r' not in text:
+            return prefix + text + color_end
+        return "".join([prefix + line + color_end
+                        for line in text.splitlines(True)])
+    return colorize
+
+
+def no_color(text):
+    return text
 
 
 ################################################################################
 ## Plugin itself.
 ################################################################################
 
+supported_error_types = [
+    (nose.DeprecatedTest, ('yellow', 'DEPRECATED')),
+    (nose.SkipTest, ('yellow', 'SKIPPED')),
+    (True, ('red', 'ERROR')),
+]
+
+
 class Spec(Plugin):
     """Generate specification from test class/method names.
     """
@@ -375,17 +524,24 @@ class Spec(Plugin):
             options.verbosity = max(options.verbosity, 2)
 
         if options.spec_color:
-            self._colorize = lambda color: lambda text: in_color(color, text)
+            self._colorizers = dict((color, colorizer(color)) for color in colors)
         else:
-            self._colorize = lambda color: lambda text: text
+            self._colorizers = dict((color, no_color) for color in colors)
 
         self.spec_doctests = options.spec_doctests
+        if self.spec_doctests:
+            self._print_context = self._print_any_context
+            self._print_spec = self._print_any_spec
+        else:
+            self._print_context = self._print_context_unless_doctest
+            self._print_spec = self._print_spec_unless_doctest
 
     def begin(self):
         self.current_context = None
+        clear_description_cache()
 
     def setOutputStream(self, stream):
-        self.stream = SpecOutputStream(stream, open(os.devnull, 'w'))
+        self.stream = SpecOutputStream(stream, devnull)
         return self.stream
 
     def beforeTest(self, test):
@@ -403,16 +559,10 @@ class Spec(Plugin):
         self._print_spec('red', test, 'FAILED')
 
     def addError(self, test, err):
-        def print_spec_func(color, message):
-            return lambda _: self._print_spec(color, test, message)
-
-        supported_error_types = [
-            (nose.DeprecatedTest, print_spec_func('yellow', 'DEPRECATED')),
-            (nose.SkipTest, print_spec_func('yellow', 'SKIPPED')),
-            (True, print_spec_func('red',    'ERROR')),
-        ]
-
-        dispatch_on_type(supported_error_types, err[1])
+        for error_type, (color, status) in supported_error_types:
+            if error_type is True or isinstance(err[1], error_type):
+                self._print_spec(color, test, status)
+                return
 
     def afterTest(self, test):
         self.stream.capture()
@@ -422,15 +572,22 @@ class Spec(Plugin):
         # Print test run summary.
         self.stream.writeln(self.stream.get_captured())
 
-    def _print_context(self, context):
-        if isinstance(context, doctest.DocTestCase) and not self.spec_doctests:
-            return
+    # One of each pair below becomes _print_context and _print_spec in
+    # configure. Hidden doctests are filtered out before any description
+    # of them gets computed.
+    def _print_any_context(self, context):
         self.stream.print_context(context)
 
-    def _print_spec(self, color, test, status=None):
-        if isinstance(test.test, doctest.DocTestCase) and not self.spec_doctests:
-            return
-        self.stream.print_spec(self._colorize(color), test, status)
+    def _print_context_unless_doctest(self, context):
+        if not isinstance(context, doctest.DocTestCase):
+            self.stream.print_context(context)
+
+    def _print_any_spec(self, color, test, status=None):
+        self.stream.print_spec(self._colorizers[color], test, status)
+
+    def _print_spec_unless_doctest(self, color, test, status=None):
+        if not isinstance(test.test, doctest.DocTestCase):
+            self.stream.print_spec(self._colorizers[color], test, status)
 
 
 if __name__ == '__main__':
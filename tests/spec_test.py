@@ -173,3 +173,9 @@ class TestColor(object):
                        \x1b[1;0m\x1b[1;32mThat is on multiple lines
                        \x1b[1;0m\x1b[1;32mthree lines to be exact.\x1b[1;0m''')
         assert in_color('green', self.multi_line) == expected
+
+    def test_color_empty_text(self):
+        assert in_color('green', '') == ''
+
+    def test_color_each_line_of_unicode_text(self):
+        assert in_color('green', u'a\x0cb') == u'\x1b[1;32ma\x0c\x1b[1;0m\x1b[1;32mb\x1b[1;0m'